@@ -1,9 +1,7 @@
 from __future__ import annotations
 from enum import Enum
 from io import BytesIO
-from queue import Queue
-import signal
-import psutil
+import selectors
 import subprocess as subp
 import sys
 import threading as th
@@ -18,16 +16,25 @@ class PipeType(Enum):
     ALL = 2
     IN = 3
 
+_PIPE_ATTR = {PipeType.ERR: 'stderr', PipeType.OUT: 'stdout', PipeType.ALL: 'all'}
+
 class CLITool:
     "Shell command."
+    _READ_BUF_SIZE = 65536
+
     def __init__(self, name:str) -> None:
         "A class that represents a shell command."
         self.name = name
         self.process:subp.Popen = None
-        self.args = []
-        self.thread = th.Thread(target=lambda:self._run())
-        self._stdout_thread = th.Thread(target=lambda:self._stdout_reader())
-        self._stderr_thread = th.Thread(target=lambda:self._stderr_reader())
+        self.args = [name]
+        self.shell = False
+        # threads are only created once the command actually runs
+        self.thread:th.Thread = None
+        self._io_thread:th.Thread = None
+        self._started = th.Event()
+        self._spawn_error:Exception = None
+        self._spawn_lock = th.Lock()
+        self._cancelled = False
 
         # operator object storage
         self._lhs_and_command:CLITool = None
@@ -38,105 +45,230 @@ class CLITool:
         self._stdout:bytes = None
         self._all:bytes = None
 
-        self._stderr_buffer:bytes = b''
-        self._stdout_buffer:bytes = b''
-        self._all_buffer:bytes = b''
+        self._stderr_buffer = bytearray()
+        self._stdout_buffer = bytearray()
+        self._merge_log:list[tuple[PipeType, int, int]] = []
 
-
-        self._all_queue = Queue()
-        self._stdout_queue = Queue()
-        self._stderr_queue = Queue()
-        self._stdin_queue = Queue()
+        self._stdout_cursor = 0
+        self._stderr_cursor = 0
+        self._data_cv = th.Condition()
+        self._eof = False
 
         self.pipe_in_type = PipeType.OUT
         self.concurrent = False
         self.has_run = False
+        self._pipe_out_type:PipeType = None
 
     def __call__(self, *args: Any) -> CLITool:
-        self.args = [self.name, *[str(arg) for arg in args]]
+        self.args = [self.name, *map(str, args)] if args else [self.name]
         return self
 
     
     def _run(self):
         "Run the command."
+        try:
+            self._spawn()
+        except BaseException as error:
+            self._end_stream()
+            if self.thread is th.current_thread() and isinstance(error, Exception):
+                # nobody can catch it on the run thread, so `finish()` raises it for the caller
+                self._spawn_error = error
+                return self
+            raise
+        finally:
+            # wake anything waiting on the process even if it failed to start
+            self._started.set()
+        if self.process == None:
+            # killed before it got to start
+            self._end_stream()
+            return self
+        self._stream()
+        return self
 
+    def _spawn(self):
+        "Starts the process once the commands it depends on are running."
         if isinstance(self._lhs_and_command, CLITool):
             self._lhs_and_command.run()
+        if self._cancelled:
+            return
         
+        stdin = subp.PIPE if self.pipe_in != None else None
         if isinstance(self.pipe_in, CLITool):
-            if not self.pipe_in.has_run:
-                self.pipe_in.run()
-            if self.pipe_in_type == PipeType.ERR:
-                self._pipe_in_data = self.pipe_in.stderr
-            elif self.pipe_in_type == PipeType.OUT:
-                self._pipe_in_data = self.pipe_in.stdout
-            elif self.pipe_in_type == PipeType.ALL:
-                self._pipe_in_data = self.pipe_in.all
+            if self.pipe_in.has_run:
+                # PipeType.IN has no output stream to take data from
+                attr = _PIPE_ATTR.get(self.pipe_in_type)
+                if attr != None:
+                    self._pipe_in_data = getattr(self.pipe_in, attr)
+            else:
+                # Hand the upstream's output pipe straight to our stdin so both run side by side.
+                stdin = self.pipe_in._run_upstream(self.pipe_in_type)
         elif self.pipe_in != None:
             self._pipe_in_data = self.pipe_in
 
+        try:
+            with self._spawn_lock:
+                if not self._cancelled:
+                    self.process = subp.Popen(" ".join(self.args) if self.shell else self.args, shell=self.shell,
+                        creationflags=subp.CREATE_NO_WINDOW if sys.platform == "win32" else 0,
+                        stdout=subp.PIPE, stderr=subp.STDOUT if self._pipe_out_type == PipeType.ALL else subp.PIPE, stdin=stdin)
+        except BaseException:
+            self._release_upstream(stdin)
+            raise
+        if self.process == None:
+            self._release_upstream(stdin)
+            return
+        self._started.set()
+        if stdin not in (subp.PIPE, None):
+            stdin.close()
+
+    def _release_upstream(self, stdin):
+        "Stops a streamed upstream whose output pipe will never be read."
+        if stdin not in (subp.PIPE, None):
+            # closing our end of the pipe lets the upstream hit EPIPE and exit before we wait on it
+            stdin.close()
+            self.pipe_in.finish()
+
+    def _run_upstream(self, pipe_out_type:PipeType):
+        "Starts the process as the left hand side of a pipe and returns the output pipe to feed downstream."
+        self.has_run = True
+        self.concurrent = True
+        self._pipe_out_type = pipe_out_type
+        try:
+            self._spawn()
+        except BaseException:
+            self._end_stream()
+            raise
+        finally:
+            # wake anything waiting on the process even if it failed to start
+            self._started.set()
+        if self.process == None:
+            self._end_stream()
+            return None
+        if pipe_out_type == PipeType.ERR:
+            pipe, self.process.stderr = self.process.stderr, None
+        else:
+            pipe, self.process.stdout = self.process.stdout, None
+        self._io_thread = th.Thread(target=lambda:self._stream())
+        self._io_thread.start()
+        return pipe
         
+    def _stream(self):
+        "Pumps the process's pipes, then wakes any iterator waiting on more output."
+        try:
+            self._io_loop()
+        finally:
+            self._end_stream()
+
+    def _end_stream(self):
+        with self._data_cv:
+            self._eof = True
+            self._data_cv.notify_all()
+
+    def _append_output(self, stream:PipeType, buffer:bytearray, data):
+        start = len(buffer)
+        buffer.extend(data)
+        self._merge_log.append((stream, start, len(buffer)))
+        with self._data_cv:
+            self._data_cv.notify_all()
+
+    def _io_loop(self):
+        "Writes piped input to stdin and reads stdout and stderr into a reusable buffer until both pipes close."
+        if os.name != "posix":
+            # Windows pipes can't be registered with a selector, so stderr and stdin get their own threads.
+            helpers:list[th.Thread] = []
+            if self.process.stderr != None:
+                helpers.append(th.Thread(target=lambda:self._pipe_reader(self.process.stderr, PipeType.ERR, self._stderr_buffer)))
+            if self.process.stdin != None:
+                helpers.append(th.Thread(target=lambda:self._pipe_writer()))
+            for helper in helpers:
+                helper.start()
+            if self.process.stdout != None:
+                self._pipe_reader(self.process.stdout, PipeType.OUT, self._stdout_buffer)
+            for helper in helpers:
+                helper.join()
+            return
         
-        self._stdout_thread.start()
-        self._stderr_thread.start()
+        readbuf = memoryview(bytearray(self._READ_BUF_SIZE))
+        pipe_in = memoryview(self._pipe_in_data)
+        written = 0
+        with selectors.DefaultSelector() as selector:
+            for pipe, stream, buffer in (
+                (self.process.stdout, PipeType.OUT, self._stdout_buffer),
+                (self.process.stderr, PipeType.ERR, self._stderr_buffer),
+            ):
+                if pipe != None:
+                    os.set_blocking(pipe.fileno(), False)
+                    selector.register(pipe, selectors.EVENT_READ, (stream, buffer))
+            if self.process.stdin != None:
+                if pipe_in:
+                    os.set_blocking(self.process.stdin.fileno(), False)
+                    selector.register(self.process.stdin, selectors.EVENT_WRITE, (PipeType.IN, None))
+                else:
+                    self.process.stdin.close()
+            while selector.get_map():
+                for key, _ in selector.select():
+                    if key.data[0] == PipeType.IN:
+                        try:
+                            written += os.write(key.fd, pipe_in[written:written + self._READ_BUF_SIZE])
+                        except BlockingIOError:
+                            continue
+                        except BrokenPipeError:
+                            written = len(pipe_in)
+                        if written >= len(pipe_in):
+                            selector.unregister(key.fileobj)
+                            self.process.stdin.close()
+                        continue
+                    try:
+                        size = os.readv(key.fd, [readbuf])
+                    except BlockingIOError:
+                        continue
+                    if not size:
+                        selector.unregister(key.fileobj)
+                        continue
+                    stream, buffer = key.data
+                    self._append_output(stream, buffer, readbuf[:size])
+
+    def _pipe_reader(self, pipe, stream:PipeType, buffer:bytearray):
+        for data in iter(pipe.readline, b''):
+            self._append_output(stream, buffer, data)
 
-        if self.pipe_in != None:
+    def _pipe_writer(self):
+        try:
             self.process.stdin.write(self._pipe_in_data)
-            self.process.stdin.flush()
+        except BrokenPipeError:
+            pass
+        finally:
             self.process.stdin.close()
-        
-        
-    
-        return self 
-        
-    def _stdout_reader(self):
-        while self.process.poll() == None if self.process != None else True:
-            try:
-                if not self.process.stdout.closed:
-                    data = self.process.stdout.readline()
-                    self._stdout_queue.put(data, False)
-                    self._stdout_buffer += data
-                    self._all_queue.put(data, False)
-                    self._all_buffer += data
-            except:
-                pass
-                
-
-    def _stderr_reader(self):
-        while self.process.poll() == None if self.process != None else True:
-            try:
-                if not self.process.stderr.closed:
-                    data = self.process.stderr.readline()
-                    self._stderr_queue.put(data, False)
-                    self._stderr_buffer += data
-                    self._all_queue.put(data, False)
-                    self._all_buffer += data
-            except:
-                pass
-        
-                
-    
-    def _kill_stream_threads(self):
-        if self._stdout_thread.is_alive():
-            self._stdout_thread.join()
-        if self._stderr_thread.is_alive():
-            self._stderr_thread.join()
-        
+
+    def _merge_streams(self) -> bytes:
+        "Interleaves stdout and stderr in the order they were read from the process."
+        with memoryview(self._stdout_buffer) as stdout, memoryview(self._stderr_buffer) as stderr:
+            views = {PipeType.OUT: stdout, PipeType.ERR: stderr}
+            # join sizes the result up front, so this is a single allocation
+            return b"".join([views[stream][start:end] for stream, start, end in self._merge_log])
     
     def finish(self, ignore_concurrent = False):
         "Blocks code untill process is finished.  Basically the same as `.join()`ing the thread."
+        if self._stdout != None or not self.has_run:
+            return
         if self.concurrent or ignore_concurrent:
-            self.process.wait()
-            self._stdout = self._stdout_buffer
-            self._stderr = self._stderr_buffer
-            self._all = self._all_buffer
+            if self.thread != None and self.thread.is_alive():
+                self.thread.join()
+            if self._spawn_error != None:
+                raise self._spawn_error
+            if self.process != None:
+                self.process.wait()
+            if self._io_thread != None and self._io_thread.is_alive():
+                self._io_thread.join()
+            self._stdout = bytes(self._stdout_buffer)
+            self._stderr = bytes(self._stderr_buffer)
+            if isinstance(self.pipe_in, CLITool) and self.pipe_in._pipe_out_type != None:
+                self.pipe_in.finish()
 
     
     def run(self):
         "Runs the process."
         self.has_run = True
-        self.process = subp.Popen(" ".join(self.args), shell=True,
-            stdout=subp.PIPE, stderr=subp.PIPE, stdin=subp.PIPE if self.pipe_in != None else None)
         if self.concurrent:
             self._run_concurrent()
         else:
@@ -147,6 +279,7 @@ class CLITool:
     
     def _run_concurrent(self):
         "Runs process on a separate thread."
+        self.thread = th.Thread(target=lambda:self._run())
         self.thread.start()
         return self
     
@@ -195,51 +328,109 @@ class CLITool:
             raise TypeError("Cant stderr pipe Shell command into type other than another shell command")
         
     def kill(self):
-        "Kills the process."
+        "Kills the process, or keeps it from starting if it is still waiting on the left hand side of `&`."
         if self.running:
-            os.kill(self.pid, signal.SIGTERM)
+            self._cancel()
         else:
             raise RuntimeError(f"Tried to kill process that doesnt exist with pid:({self.pid}).")
         return self
+
+    def _cancel(self):
+        with self._spawn_lock:
+            self._cancelled = True
+            process = self.process
+        if process != None:
+            if process.poll() == None:
+                process.terminate()
+            return
+        # still waiting to start, so stop whatever it is waiting on
+        if isinstance(self._lhs_and_command, CLITool) and self._lhs_and_command.has_run:
+            self._lhs_and_command._cancel()
+        if isinstance(self.pipe_in, CLITool) and self.pipe_in._pipe_out_type != None:
+            self.pipe_in._cancel()
     
     def __iter__(self):
         return self
 
 
     def __next__(self):
-        
-        if self._stdout_queue.empty() and self._stderr_queue.empty():
+        "Blocks until the process emits more output, raising `StopIteration` once it has closed its streams."
+        if not self.has_run:
             raise StopIteration()
-        
-        return self.next_stream_line()
+        stdout, stderr = self.next_stream_line()
+        if stdout == None and stderr == None:
+            # only take the condition's lock when there is nothing to return yet
+            with self._data_cv:
+                while self.stream_empty and not self._eof:
+                    self._data_cv.wait()
+            stdout, stderr = self.next_stream_line()
+            if stdout == None and stderr == None:
+                raise StopIteration()
+        return (stdout, stderr)
         
         
     def next_stream_line(self):
         "Grabs next `(stdout, stderr)` in the stream captured durring runtime.\n\n~~NOTE~~: If the stdout is buffered, it will not capture the stdout and stderr until the process is complete."
         stdout:bytes | None = None
-        if not self._stdout_queue.empty():
-            stdout = self._stdout_queue.get(False)
+        end = len(self._stdout_buffer)
+        if self._stdout_cursor < end:
+            stdout = bytes(self._stdout_buffer[self._stdout_cursor:end])
+            self._stdout_cursor = end
 
         stderr:bytes | None = None
-        if not self._stderr_queue.empty():
-            stderr = self._stderr_queue.get(False)
-        
+        end = len(self._stderr_buffer)
+        if self._stderr_cursor < end:
+            stderr = bytes(self._stderr_buffer[self._stderr_cursor:end])
+            self._stderr_cursor = end
         
         return (stdout, stderr)
 
+    def next_stream_view(self) -> tuple[memoryview | None, memoryview | None]:
+        "Same as `next_stream_line` but grabs `(stdout, stderr)` as `memoryview`s.\n\nOnce the process has closed its streams the views point straight into the captured output without copying.  While it is still writing, each view is over a copy, since a view into the live buffer would stop it from growing."
+        stdout, self._stdout_cursor = self._take_view(self._stdout_buffer, self._stdout_cursor)
+        stderr, self._stderr_cursor = self._take_view(self._stderr_buffer, self._stderr_cursor)
+        return (stdout, stderr)
+
+    def _take_view(self, buffer:bytearray, cursor:int) -> tuple[memoryview | None, int]:
+        done = self._eof
+        end = len(buffer)
+        if end == cursor:
+            return (None, cursor)
+        if done:
+            return (memoryview(buffer)[cursor:end], end)
+        return (memoryview(buffer[cursor:end]), end)
+
+    def next_line(self):
+        "Grabs the next complete `(stdout, stderr)` lines captured durring runtime.\n\nA last line without a trailing newline is only returned once the process has closed its streams."
+        stdout, self._stdout_cursor = self._take_line(self._stdout_buffer, self._stdout_cursor)
+        stderr, self._stderr_cursor = self._take_line(self._stderr_buffer, self._stderr_cursor)
+        return (stdout, stderr)
+
+    def _take_line(self, buffer:bytearray, cursor:int) -> tuple[bytes | None, int]:
+        done = self._eof
+        end = buffer.find(b"\n", cursor) + 1
+        if not end:
+            end = len(buffer) if done else cursor
+        if end == cursor:
+            return (None, cursor)
+        return (bytes(buffer[cursor:end]), end)
+
     @property
     def running(self):
         "Returns True if the process is running, False if not."
-        return self.process.poll() == None if self.process != None else False
+        if self.process == None:
+            return self.thread != None and self.thread.is_alive()
+        return self.process.poll() == None
     
     @property
     def stream_empty(self):
         "Returns True if the stdout and stderr streams are empty, False if not."
-        
-        return self._stdout_queue.empty() and self._stderr_queue.empty()
+        return self._stdout_cursor == len(self._stdout_buffer) and self._stderr_cursor == len(self._stderr_buffer)
     
     @property
     def return_code(self):
+        if self._spawn_error != None:
+            raise self._spawn_error
         if not self.running and self.process != None:
             return self.process.returncode
         else:
@@ -247,6 +438,8 @@ class CLITool:
 
     @property
     def pid(self):
+        if self.has_run:
+            self._started.wait()
         if self.process != None:
             return self.process.pid
         return None
@@ -270,12 +463,11 @@ class CLITool:
         if self._all != None:
             return self._all
         self.finish()
+        if self._stdout != None:
+            self._all = self._merge_streams()
         return self._all
 
 class Shell:
-    def __getattribute__(self, name: str) -> CLITool:
-        "Shell command."
-        return CLITool(name)
     def __getitem__(self, name: str) -> CLITool:
         "Shell command."
         return CLITool(name)
@@ -292,9 +484,7 @@ if __name__ == "__main__":
     process = ~SHELL.python("-u", "./test/t1.py")
     #process = ~(SHELL.timeout(5) & SHELL.findstr("/s", "/c:Tool", "C:/Users/William/Documents/Programming Repos/*.py") | SHELL.findstr("/s", "/c:SHELL"))
     process.run()
-    while process.running or not process.stream_empty:
-        out, err = process.next_stream_line()
-
+    for out, err in process:
         if out:
             print(f"PROCESS RUNNING: {process.running}")
             sys.stdout.write(f"out:\n{out.decode()}")